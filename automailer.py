@@ -1,13 +1,19 @@
-import pandas as pd
+import openpyxl
 import msal
 import requests
+import orjson
+from requests.adapters import HTTPAdapter
 from config import EMAIL_TEMPLATES, CLIENT_ID, CLIENT_SECRET, TENANT_ID, EMAIL_ADDRESS, CC_EMAIL, GRAPH_API_ENDPOINT
 import re
+from operator import itemgetter
+import os
+import atexit
 import logging
+import logging.handlers
 import sys
 import time
-import tkinter as tk
-from tkinter import filedialog
+import bisect
+import threading
 from validate_email import validate_email
 import smtplib
 import dns.resolver
@@ -39,7 +45,19 @@ def choose_template():
     return template
     
 # a method to select a chosen excel file for automailing
+# the file can be passed on the command line, otherwise a file dialog is opened
 def select_excel_file():
+    if len(sys.argv) > 1:
+        if not os.path.isfile(sys.argv[1]):
+            logging.error(f"The file '{sys.argv[1]}' was not found.")
+            sys.exit(1)  # Exit rather than fall back to the dialog, which may not be available
+        print(f"File selected: {sys.argv[1]}")
+        return sys.argv[1]
+
+    # Only pay for importing and starting Tk when the dialog is actually needed
+    import tkinter as tk
+    from tkinter import filedialog
+
     root = tk.Tk()
     root.lift()
     root.focus_force()
@@ -48,6 +66,7 @@ def select_excel_file():
         title = "Select an excel file",
         filetypes=[("Excel files", "*.xlsx"), ("All files", "*.*")]
     )
+    root.destroy()
 
     if file_path:
         print(f"File selected: {file_path}")
@@ -56,70 +75,241 @@ def select_excel_file():
         print("No file selected")
         return None
 
+# read the contacts from the first sheet of an excel file
+def read_contacts(file_path):
+    """
+    Reads contacts from an Excel file using openpyxl's read-only mode, skipping pandas entirely.
+    Returns a list of (row_number, email, name, company) tuples.
+    Missing names and companies are filled in with 'Friend' and 'Valued Partner'.
+    Blank rows are kept (and reported as missing an email later), except for trailing blank rows.
+    """
+    workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = next(rows, ())
+        idx = {column: i for i, column in enumerate(header)}
+
+        # Resolve column positions once; missing columns point at the None padding after the header's width
+        padding = len(header)
+        get_fields = itemgetter(idx.get('Email', padding), idx.get('Name', padding), idx.get('Company', padding))
+
+        contacts = []
+        blank_rows = []  # Blank rows are only kept once a non-blank row follows them
+        for row_number, row in enumerate(rows, start=2):  # Row 1 is the header
+            if all(value is None for value in row):
+                blank_rows.append((row_number, None, 'Friend', 'Valued Partner'))
+                continue
+            contacts.extend(blank_rows)
+            blank_rows = []
+            # Read-only rows can stop at the last non-empty cell, so pad every row to the full width
+            row = row[:padding]
+            email, name, company = get_fields(row + (None,) * (padding + 1 - len(row)))
+            contacts.append((
+                row_number,
+                email,
+                'Friend' if name is None else name,  # Default name if missing
+                'Valued Partner' if company is None else company  # Default to 'Valued Partner' if 'company' is missing
+            ))
+        return contacts
+    finally:
+        workbook.close()
+
 # -------------------- Logging Configuration -------------------- #
 
-# Configure logging to write INFO and higher level messages to 'email_logs.log'
-logging.basicConfig(
-    filename='email_logs.log', # Create a logs file to record errors or successes
-    level=logging.DEBUG,  # Changed from INFO to DEBUG for more information
-    format='%(asctime)s:%(levelname)s:%(message)s'
-)
+# Write DEBUG and higher level messages to 'email_logs.log' to record errors or successes.
+# File writes are buffered and flushed every 256 records, on any error, and at exit.
+file_handler = logging.FileHandler('email_logs.log', delay=True)
+file_handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(message)s'))
+buffered_file_handler = logging.handlers.MemoryHandler(capacity=256, flushLevel=logging.ERROR, target=file_handler)
+
+# Echo INFO and higher level messages to the console from the same logging calls
+console_handler = logging.StreamHandler(sys.stdout)
+console_handler.setLevel(logging.INFO)
+console_handler.setFormatter(logging.Formatter('%(message)s'))
+
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+logger.addHandler(buffered_file_handler)
+logger.addHandler(console_handler)
+
+# -------------------- HTTP Session -------------------- #
+
+# Reuse a single session so every Graph API call shares pooled keep-alive connections
+SESSION = requests.Session()
+# Request bodies are encoded with orjson, so the JSON content type is set here explicitly
+SESSION.headers.update({"Content-Type": "application/json"})
+SESSION.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=32))
+
+# -------------------- Token Cache -------------------- #
+
+# OAuth2 tokens are cached on disk so reruns can skip the login round-trip
+TOKEN_CACHE_PATH = "msal_cache.bin"
+
+# Refresh tokens this long before they expire. MSAL treats tokens within 5 minutes
+# of expiry as stale, so this must stay under 300 seconds to get a fresh token back.
+TOKEN_REFRESH_MARGIN_SECONDS = 240
+
+_token_app = None  # Built once and reused for every token refresh
+_token_expires_at = 0
+_token_lock = threading.Lock()
+
+# -------------------- Sending Configuration -------------------- #
+
+# Simple regex used to validate email addresses, compiled once
+_EMAIL_RE = re.compile(r'^[\w\.-]+@[\w\.-]+\.\w+$')
+
+# Static CC recipient list, built once and shared by every email payload
+_CC_LIST = [{"emailAddress": {"address": CC_EMAIL}}]
+
+# Microsoft Graph accepts at most 20 requests in a single $batch call. 15 is used instead because
+# it divides the 30 emails per minute mailbox limit, so two full batches fill each minute.
+# All requests send from the same mailbox, which only allows 4 concurrent requests, so each
+# sendMail request in a batch depends on the one before it and Graph runs them one at a time.
+GRAPH_BATCH_LIMIT = 15
+
+# Retry throttled (429) and server error (5xx) responses with exponential backoff
+MAX_RETRIES = 5
+MAX_BACKOFF_SECONDS = 60
+
+# Exchange Online mailbox sending limits as (max emails, window in seconds).
+# The daily limit is 10000 recipients, not emails. Each email goes to its recipient
+# plus everyone in _CC_LIST, so the daily limit is converted to a number of emails.
+MAILBOX_SEND_LIMITS = [(30, 60), (10000 // (1 + len(_CC_LIST)), 24 * 60 * 60)]
+
+class RateLimiter:
+    """
+    A thread-safe rolling-window limiter that keeps sends under the mailbox sending limits.
+    acquire(count) only sleeps when 'count' more sends would exceed a limit, and
+    record(count) counts the sends that were actually accepted.
+    'count' must not exceed the smallest limit.
+    """
+    def __init__(self, limits):
+        self.limits = limits
+        self.longest_window = max(window for _, window in limits)
+        self.sent = []  # Send timestamps, oldest first
+        self.lock = threading.Lock()
+
+    def acquire(self, count=1):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+
+                # Forget sends that have fallen out of every window
+                del self.sent[:bisect.bisect_right(self.sent, now - self.longest_window)]
+
+                wait = 0
+                for max_sends, window in self.limits:
+                    start = bisect.bisect_right(self.sent, now - window)
+                    excess = len(self.sent) - start + count - max_sends
+                    if excess > 0:
+                        # Wait until enough of the oldest sends in this window have expired
+                        wait = max(wait, self.sent[start + excess - 1] + window - now)
+
+                if wait <= 0:
+                    return
+            time.sleep(wait)
+
+    def record(self, count):
+        with self.lock:
+            self.sent.extend([time.monotonic()] * count)
+
+RATE_LIMITER = RateLimiter(MAILBOX_SEND_LIMITS)
 
 # -------------------- Function Definitions -------------------- #
 
-def is_valid_email(email):
+def load_token_cache():
     """
-    Validates the email address using a simple regex.
-    Returns True if valid, False otherwise.
+    Loads the MSAL token cache from TOKEN_CACHE_PATH if it exists.
+    The cache is written back to disk when the script exits.
     """
-    regex = r'^[\w\.-]+@[\w\.-]+\.\w+$'
-    return re.match(regex, email) is not None
+    cache = msal.SerializableTokenCache()
+    if os.path.exists(TOKEN_CACHE_PATH):
+        with open(TOKEN_CACHE_PATH, "r") as cache_file:
+            try:
+                cache.deserialize(cache_file.read())
+            except ValueError as e:
+                # A corrupt cache (e.g. from an interrupted write) just means requesting a new token
+                logging.warning(f"Ignoring unreadable token cache '{TOKEN_CACHE_PATH}': {e}")
+                cache = msal.SerializableTokenCache()
+
+    def save_token_cache():
+        if cache.has_state_changed:
+            # The cache holds a bearer token that can send mail, so keep it readable by the owner only
+            fd = os.open(TOKEN_CACHE_PATH, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            os.chmod(TOKEN_CACHE_PATH, 0o600)  # Also tighten a cache file left over from an earlier run
+            with os.fdopen(fd, "w") as cache_file:
+                cache_file.write(cache.serialize())
+
+    atexit.register(save_token_cache)
+    return cache
 
 def acquire_token(client_id, client_secret, tenant_id):
     """
     Acquires an OAuth2 token using the Client Credentials flow.
+    A cached token is reused when one is still valid, otherwise a new one is requested.
     This token will be used to authenticate with the Microsoft Graph API.
+    Returns the access token and the time (in seconds since the epoch) at which it expires.
     """
-    authority = f"https://login.microsoftonline.com/{tenant_id}"
-    app = msal.ConfidentialClientApplication(
-        client_id,
-        authority=authority,
-        client_credential=client_secret,
-    )
+    global _token_app
+    if _token_app is None:
+        authority = f"https://login.microsoftonline.com/{tenant_id}"
+        _token_app = msal.ConfidentialClientApplication(
+            client_id,
+            authority=authority,
+            client_credential=client_secret,
+            token_cache=load_token_cache(),
+        )
     scopes = ["https://graph.microsoft.com/.default"]  # Scopes required by the app
 
     logging.info("Attempting to acquire OAuth2 token.") 
-    result = app.acquire_token_for_client(scopes=scopes)
+    # acquire_token_for_client returns a valid cached token before requesting a new one
+    result = _token_app.acquire_token_for_client(scopes=scopes)
 
     if "access_token" in result:
-        logging.info("OAuth2 token acquired successfully.")
-        return result["access_token"]
+        logging.info(f"OAuth2 token acquired successfully from {result.get('token_source', 'identity_provider')}.")
+        return result["access_token"], time.time() + int(result.get("expires_in", 0))
     else:
         error_msg = f"Failed to acquire token: {result.get('error_description')}"
         logging.error(error_msg)
-        print(error_msg)
         sys.exit(1)  # Exit the script if token acquisition fails
 
-def send_email(access_token, recipient, subject, body):
+def authorize_session():
+    """
+    Acquires an OAuth2 token and attaches it to the shared SESSION.
+    """
+    global _token_expires_at
+    access_token, _token_expires_at = acquire_token(CLIENT_ID, CLIENT_SECRET, TENANT_ID)
+    SESSION.headers.update({"Authorization": f"Bearer {access_token}"})
+
+def refresh_token_if_expiring():
+    """
+    Refreshes the SESSION's OAuth2 token shortly before it expires,
+    so long sending runs do not fail with 401 errors partway through.
+    """
+    with _token_lock:
+        if time.time() >= _token_expires_at - TOKEN_REFRESH_MARGIN_SECONDS:
+            logging.info("OAuth2 token is about to expire. Refreshing.")
+            authorize_session()
+
+def retry_delay(headers, attempt):
     """
-    Sends an email using the Microsoft Graph API.
+    Returns how many seconds to wait before retrying a throttled or failed request.
+    Uses the server's Retry-After header when present, otherwise exponential backoff.
+    """
+    retry_after = headers.get("Retry-After")
+    if retry_after is not None and str(retry_after).isdigit():
+        return int(retry_after)
+    return min(2 ** attempt, MAX_BACKOFF_SECONDS)
+
+def build_email_message(recipient, subject, body):
+    """
+    Builds the JSON payload for a single Graph API sendMail request.
     Parameters:
-        - access_token: OAuth2 token for authentication
         - recipient: Recipient's email address
         - subject: Subject of the email
         - body: Body content of the email
     """
-    # Construct the API endpoint for sending mail
-    url = f"{GRAPH_API_ENDPOINT}/users/{EMAIL_ADDRESS}/sendMail"
-
-    # Set up the request headers with the OAuth2 token
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json"
-    }
-
-    # Construct the email payload in JSON format
-    email_msg = {
+    return {
         "message": {
             "subject": subject,
             "body": {
@@ -133,36 +323,103 @@ def send_email(access_token, recipient, subject, body):
                     }
                 }
             ],
-            "ccRecipients": [
-                {
-                    "emailAddress": {
-                        "address": CC_EMAIL  # Static CC recipient
-                    }
-                }
-            ]
+            "ccRecipients": _CC_LIST  # Shared, never mutated
         },
         "saveToSentItems": "true"  # true means that emails are saved in sent items
     }
 
-    try:
-        # Make a POST request to the Graph API to send the email
-        response = requests.post(url, headers=headers, json=email_msg)
+def send_email_batch(messages):
+    """
+    Sends up to GRAPH_BATCH_LIMIT emails in a single Microsoft Graph $batch request.
+    The requests are chained with dependsOn so they run one after another.
+    Throttled (429), server error (5xx) and skipped (424) requests are retried with
+    exponential backoff, honoring the server's Retry-After delay when one is given.
+    Parameters:
+        - messages: List of (recipient, subject, body) tuples
+    """
+    # Construct the API endpoint for batching requests
+    url = f"{GRAPH_API_ENDPOINT}/$batch"
 
-        if response.status_code == 202:
-            # 202 Accepted indicates the email was accepted for delivery
-            logging.info(f"Email successfully sent to {recipient}")
-            print(f"Email successfully sent to {recipient}")
-        else:
+    # Map each batch request id to its message so responses can be matched back up
+    pending = {str(i): message for i, message in enumerate(messages)}
+
+    for attempt in range(MAX_RETRIES + 1):
+        batch_requests = []
+        previous_id = None
+        for request_id, (recipient, subject, body) in pending.items():
+            request = {
+                "id": request_id,
+                "method": "POST",
+                "url": f"/users/{EMAIL_ADDRESS}/sendMail",
+                "headers": {"Content-Type": "application/json"},
+                "body": build_email_message(recipient, subject, body)
+            }
+            if previous_id is not None:
+                # Wait for the previous email so the mailbox only sees one request at a time
+                request["dependsOn"] = [previous_id]
+            batch_requests.append(request)
+            previous_id = request_id
+        batch = {"requests": batch_requests}
+
+        try:
+            # Make a single POST request to the Graph API for the whole batch.
+            # Waiting on the rate limiter can take a long time, so check the token afterwards.
+            RATE_LIMITER.acquire(len(pending))
+            refresh_token_if_expiring()
+            response = SESSION.post(url, data=orjson.dumps(batch))
+        except requests.exceptions.RequestException as e:
+            # Handle any network-related errors
+            for recipient, _, _ in pending.values():
+                error_msg = f"An error occurred while sending email to {recipient}: {e}"
+                logging.error(error_msg)
+            return
+
+        if response.status_code == 429 or response.status_code >= 500:
+            # The whole batch was throttled or failed server-side, back off and try again
+            if attempt < MAX_RETRIES:
+                delay = retry_delay(response.headers, attempt)
+                logging.warning(f"Batch request returned {response.status_code}. Retrying in {delay} seconds.")
+                time.sleep(delay)
+                continue
+
+        if response.status_code != 200:
             # Log the error details for troubleshooting
-            error_msg = f"Failed to send email to {recipient}: {response.status_code} {response.text}"
-            logging.error(error_msg)
-            print(error_msg)
+            for recipient, _, _ in pending.values():
+                error_msg = f"Failed to send email to {recipient}: {response.status_code} {response.text}"
+                logging.error(error_msg)
+            return
 
-    except requests.exceptions.RequestException as e:
-        # Handle any network-related errors
-        error_msg = f"An error occurred while sending email to {recipient}: {e}"
-        logging.error(error_msg)
-        print(error_msg)
+        retryable = {}
+        delay = 0
+        accepted = 0
+        # Responses can come back in any order, so walk them in request order to keep the chain intact on retry
+        results = {result["id"]: result for result in orjson.loads(response.content).get("responses", [])}
+        for request_id, (recipient, _, _) in pending.items():
+            result = results.get(request_id, {})
+            status = result.get("status", 0)
+
+            if status == 202:
+                # 202 Accepted indicates the email was accepted for delivery
+                logging.info(f"Email successfully sent to {recipient}")
+                accepted += 1
+            elif (status in (424, 429) or status >= 500) and attempt < MAX_RETRIES:
+                # Hold on to throttled or failed requests, and requests skipped (424)
+                # because an earlier request in the chain failed, so they can be retried
+                retryable[request_id] = pending[request_id]
+                delay = max(delay, retry_delay(result.get("headers", {}), attempt))
+            else:
+                # Log the error details for troubleshooting
+                error_msg = f"Failed to send email to {recipient}: {status} {result.get('body')}"
+                logging.error(error_msg)
+
+        # Only accepted emails count against the mailbox sending limits
+        RATE_LIMITER.record(accepted)
+
+        pending = retryable
+        if not pending:
+            return
+        logging.warning(f"{len(pending)} emails throttled or failed. Retrying in {delay} seconds.")
+        time.sleep(delay)
 
 # -------------------- Main Execution -------------------- #
 
@@ -171,51 +428,52 @@ def main():
     Main function to read contacts from an Excel file and send emails to each contact.
     """
     # Step 1: Acquire OAuth2 Token
-    access_token = acquire_token(CLIENT_ID, CLIENT_SECRET, TENANT_ID)
+    authorize_session()
 
     # Step 2: Read Contacts from Excel
+    excel_file = select_excel_file()
     try:
-        excel_file = select_excel_file()
-        contacts = pd.read_excel(excel_file)
+        contacts = read_contacts(excel_file)
         logging.info(f"Successfully read {len(contacts)} contacts from '{excel_file}'.")
     except FileNotFoundError:
         error_msg = f"The file '{excel_file}' was not found."
         logging.error(error_msg)
-        print(error_msg)
         sys.exit(1)  # Exit the script if the Excel file is not found
     except Exception as e:
         error_msg = f"An error occurred while reading '{excel_file}': {e}"
         logging.error(error_msg)
-        print(error_msg)
         sys.exit(1)  # Exit the script for any other read errors
 
     # Step 3 : Choose the email template
     email_template = choose_template()
 
-    # Step 4: Iterate Through Contacts and Send Emails
-    for index, contact in contacts.iterrows():
-        to_email = contact.get('Email')
-        name = contact.get('Name', 'Friend')  # Default name if missing
-        company = contact.get('Company', 'Valued Partner')  # Default to 'Valued Partner' if 'company' is missing
-
-
+    # Step 4: Validate and format every email before sending anything
+    subject_uses_company = "{company}" in email_template
+    messages = []
+    seen_emails = set()  # Normalized addresses already queued, so duplicates are only sent once
+    for row_number, to_email, name, company in contacts:
         # Validate email address
         # if validate_email(to_email):
         #     warning_msg = f"Email address: {to_email} is invalid. Domain may be unreachable."
         #     logging.warning(warning_msg)
-        #     print(warning_msg)
         #     continue
 
-        if pd.isna(to_email):
-            warning_msg = f"Row {index + 2}: Missing email address. Skipping."
+        if to_email is None:
+            warning_msg = f"Row {row_number}: Missing email address. Skipping."
+            logging.warning(warning_msg)
+            continue  # Skip to the next contact
+
+        # Strip surrounding whitespace once so validation, sending and dedup all use the same address
+        to_email = str(to_email).strip()
+        normalized_email = to_email.lower()
+        if normalized_email in seen_emails:
+            warning_msg = f"Row {row_number}: Duplicate email address '{to_email}'. Skipping."
             logging.warning(warning_msg)
-            print(warning_msg)
             continue  # Skip to the next contact
 
-        if not is_valid_email(to_email):
-            warning_msg = f"Row {index + 2}: Invalid email address '{to_email}'. Skipping."
+        if _EMAIL_RE.match(to_email) is None:
+            warning_msg = f"Row {row_number}: Invalid email address '{to_email}'. Skipping."
             logging.warning(warning_msg)
-            print(warning_msg)
             continue  # Skip to the next contact
 
         # Format the email content using the plain text template
@@ -224,25 +482,24 @@ def main():
         except KeyError as e:
             error_msg = f"Missing placeholder data {e} for email to {to_email}. Skipping."
             logging.error(error_msg)
-            print(error_msg)
             continue  # Skip to the next contact if formatting fails
         except Exception as e:
             error_msg = f"Error formatting email for {to_email}: {e}. Skipping."
             logging.error(error_msg)
-            print(error_msg)
             continue  # Skip to the next contact for any other formatting errors
 
         # Define the subject of the email
-        if "{company}" in email_template:
+        if subject_uses_company:
             subject = f"{company} - Henrich"
         else:
             subject = f"{name} - Henrich"
 
-        # Send the email using the Graph API
-        send_email(access_token, to_email, subject, plain_text_content)
+        messages.append((to_email, subject, plain_text_content))
+        seen_emails.add(normalized_email)  # Only queued addresses count as duplicates
 
-        #Throttle emails to comply with sending limits
-        time.sleep(5)
+    # Step 5: Send the emails using the Graph API, GRAPH_BATCH_LIMIT at a time
+    for start in range(0, len(messages), GRAPH_BATCH_LIMIT):
+        send_email_batch(messages[start:start + GRAPH_BATCH_LIMIT])
 
 if __name__ == "__main__":
     main()